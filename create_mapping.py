@@ -14,34 +14,61 @@ background_2 = 'data/tp002_mode02_bias_corrected.nii.gz'
 background1_data = load_nifti_image(background_1)
 background2_data = load_nifti_image(background_2)
 
-image1_data = load_nifti_image(lesion_mask1)
+image1_data, image1_affine = load_nifti_image(lesion_mask1, return_affine=True)
 image1_labels, _ = find_and_label_regions(image1_data)
 
-image2_data = load_nifti_image(lesion_mask2)
+image2_data, image2_affine = load_nifti_image(lesion_mask2, return_affine=True)
 image2_labels, _ = find_and_label_regions(image2_data)
 
 
-# Compute properties for each labeled image
-image1_properties = compute_region_properties(image1_labels)
-image2_properties = compute_region_properties(image2_labels)
+# Sensitivity of the lesion counts to the threshold ratio, computed in a single pass per image
+threshold_sweep = [0.1, 0.3, 0.5, 0.7, 0.9]
+print('Lesion counts per threshold ratio (first time point)',
+      find_and_label_regions_sweep(image1_data, threshold_sweep, return_labels=False))
+print('Lesion counts per threshold ratio (second time point)',
+      find_and_label_regions_sweep(image2_data, threshold_sweep, return_labels=False))
+
+
+# Compute properties for each labeled image (voxel and mm metrics)
+image1_properties = compute_region_properties(image1_labels, image1_affine)
+image2_properties = compute_region_properties(image2_labels, image2_affine)
 
 
 
 # Store the dictionaries in an array or list
 region_properties_array = [image1_properties, image2_properties]
 
-for region_id1 in image1_properties:
-    #plot_region_center_full_size(image1_data, image1_properties, region_id1, 1)
-    plot_region_center_full_size_bg(background1_data, image1_labels,  image1_properties, region_id1, 1)
+# One montage of all lesions per time point; set per_lesion_plots to also write one image per lesion
+plot_lesion_montage(background1_data, image1_labels, image1_properties, 1)
+plot_lesion_montage(background2_data, image2_labels, image2_properties, 2)
+
+per_lesion_plots = False
+if per_lesion_plots:
+    for region_id1 in image1_properties:
+        #plot_region_center_full_size(image1_data, image1_properties, region_id1, 1)
+        plot_region_center_full_size_bg(background1_data, image1_labels,  image1_properties, region_id1, 1)
 
-for region_id2 in image2_properties:
-    plot_region_center_full_size_bg(background1_data, image2_labels, image2_properties, region_id2, 2)
+    for region_id2 in image2_properties:
+        plot_region_center_full_size_bg(background1_data, image2_labels, image2_properties, region_id2, 2)
 
 
 # Assuming you have two labeled images: image1_labels and image2_labels
 
 # Build the mapping based on the spatial overlap
-region_mapping = map_regions(image1_labels, image2_labels)
+# Matches whose centroids are further apart than max_centroid_distance (mm) are rejected
+max_centroid_distance = None
+# The second time point is resampled into the first image's grid when shapes or affines differ
+resample_cache_dir = 'output/cache'
+# Lesions without overlap are matched to the nearest unclaimed lesion within fallback_distance (mm)
+fallback_distance = 5.0
+# 'greedy' maps each lesion to its most overlapping lesion, 'assignment' enforces a one-to-one matching
+mapping_mode = 'greedy'
+# The match scores hold the overlap, Dice and IoU of each match
+region_mapping, region_provenance, region_match_scores = map_regions(image1_labels, image2_labels, image1_affine,
+                                                                     max_centroid_distance, image2_affine,
+                                                                     resample_cache_dir, fallback_distance,
+                                                                     return_provenance=True, mode=mapping_mode,
+                                                                     return_scores=True)
 
 # Now, region_mapping contains the associations between regions in image1 and image2
 print(region_mapping)
@@ -70,7 +97,9 @@ print('Number of lesions that seems to have disappeared is', count_none_mappings
 
 #here u can use the same mapping function but in reverse order, to find out if a new lesion exist
 
-region_mapping_backward =  map_regions(image2_labels, image1_labels)
+region_mapping_backward, region_provenance_backward, region_match_scores_backward = map_regions(
+    image2_labels, image1_labels, image2_affine, max_centroid_distance, image1_affine, resample_cache_dir,
+    fallback_distance, return_provenance=True, mode=mapping_mode, return_scores=True)
 
 print('Number of new lesions that didnt seem to have a precedent is', count_none_mappings(region_mapping_backward)
       )
@@ -80,7 +109,11 @@ save_mapping_data_to_json(region_mapping,
                           image1_data,
                           image2_data,
                           image1_labels,
-                          image2_labels, "output/output_data_log.json")
+                          image2_labels, "output/output_data_log.json",
+                          region_provenance,
+                          region_provenance_backward,
+                          region_match_scores,
+                          region_match_scores_backward)
 
 #Now use difference_computation.py to build the difference to see if it increased, or decreased to stayed the same
 #Use the same code while adding a condition using the mask label
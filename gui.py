@@ -4,11 +4,14 @@ from PIL import Image, ImageTk
 import numpy as np
 import nibabel as nib
 import os
+from visualisation import montage_tile_boxes
 
 
 class NiiImageViewerApp:
     def __init__(self, root, bg1_path, mask1_path, bg2_path, mask2_path, lesions_folder1, lesions_folder2):
         self.root = root
+        # Montage tile of each lesion entry, per lesions folder
+        self.tile_boxes = {}
         root.title("NII Image Viewer")
 
         # Displaying the first set of NII images (background and mask)
@@ -55,7 +58,14 @@ class NiiImageViewerApp:
         return overlay.astype(np.uint8)
 
     def initialize_lesion_dropdown(self, folder, label, side):
-        lesion_images = sorted([f for f in os.listdir(folder) if f.endswith('.png')])
+        if os.path.exists(os.path.join(folder, 'montage_index.json')):
+            # One entry per lesion, shown as its tile cropped from the montage pages
+            self.tile_boxes[folder] = {f'Lesion {lesion_id}': box
+                                       for lesion_id, box in montage_tile_boxes(folder).items()}
+            lesion_images = list(self.tile_boxes[folder])
+        else:
+            # Per-lesion images written by create_mapping.py with per_lesion_plots
+            lesion_images = sorted([f for f in os.listdir(folder) if f.endswith('.png')])
         selected_lesion_var = tk.StringVar(self.root)
         selected_lesion_var.set(lesion_images[0])  # default value
 
@@ -64,8 +74,12 @@ class NiiImageViewerApp:
         lesion_dropdown.pack(side=side, fill="x")
 
     def update_lesion_image(self, folder, selection, label):
-        image_path = os.path.join(folder, selection)
-        image = Image.open(image_path).resize((300, 200))  # Resize to fit
+        if selection in self.tile_boxes.get(folder, {}):
+            file_name, box = self.tile_boxes[folder][selection]
+            image = Image.open(os.path.join(folder, file_name)).crop(box).resize((300, 300))  # Square tiles
+        else:
+            image_path = os.path.join(folder, selection)
+            image = Image.open(image_path).resize((300, 200))  # Resize to fit
         photo = ImageTk.PhotoImage(image)
 
         label.configure(image=photo)
@@ -0,0 +1,366 @@
+import argparse
+import hashlib
+import inspect
+import json
+import os
+import pickle
+
+import report_generation
+import utils
+import visualisation
+from utils import *
+from visualisation import plot_labeled_regions_with_mapping, plot_lesion_montage, plot_difference_slice
+from report_generation import generate_pdf, load_data
+
+
+# Paths to your .nii.gz files - placeholder values
+SUBJECT = {
+    'mask1': 'data/tp001_lesions_manual.nii.gz',
+    'mask2': 'data/tp002_lesions_manual.nii.gz',
+    'background1': 'data/tp001_mode02_bias_corrected.nii.gz',
+    'background2': 'data/tp002_mode02_bias_corrected.nii.gz',
+}
+
+# Parameters of every stage; changing one only reruns the stages that use it and their downstream stages
+PARAMETERS = {
+    'threshold_ratio': 0.5,
+    'max_centroid_distance': None,
+    'fallback_distance': 5.0,
+    'mapping_mode': 'greedy',
+    'resample_cache_dir': 'output/cache',
+    'montage_columns': 8,
+    'montage_tiles_per_page': 64,
+    # Plot zoom: side of the montage tiles in voxels (None fits the largest lesion plus the margin)
+    'montage_tile_size': None,
+    'montage_margin': 8,
+    'json_filename': 'output/output_data_log.json',
+    'pdf_filename': 'output/lesion_tracking_report.pdf',
+}
+
+
+def stage_load(inputs, subject):
+    """
+    Load the lesion masks and backgrounds of both time points.
+
+    :param subject: Dictionary mapping a volume name to its NIfTI path.
+    :return: Dictionary mapping each volume name to (data, affine).
+    """
+    return load_subject_volumes(subject)
+
+
+def stage_label(inputs, threshold_ratio):
+    """
+    Label the connected lesions of both masks.
+
+    :return: Labeled image arrays of both time points.
+    """
+    volumes = inputs['load']
+    image1_labels, _ = find_and_label_regions(volumes['mask1'][0], threshold_ratio)
+    image2_labels, _ = find_and_label_regions(volumes['mask2'][0], threshold_ratio)
+    return image1_labels, image2_labels
+
+
+def stage_properties(inputs):
+    """
+    Compute the voxel and physical-space properties of the lesions of both time points.
+
+    :return: Properties of both time points.
+    """
+    volumes = inputs['load']
+    image1_labels, image2_labels = inputs['label']
+    return (compute_region_properties(image1_labels, volumes['mask1'][1]),
+            compute_region_properties(image2_labels, volumes['mask2'][1]))
+
+
+def stage_map(inputs, max_centroid_distance, fallback_distance, mapping_mode, resample_cache_dir):
+    """
+    Map the lesions forward and backward between both time points.
+
+    :return: Dictionary with the forward and backward mappings, their provenance and their match scores.
+    """
+    volumes = inputs['load']
+    image1_labels, image2_labels = inputs['label']
+    affine1, affine2 = volumes['mask1'][1], volumes['mask2'][1]
+    forward, provenance, match_scores = map_regions(image1_labels, image2_labels, affine1, max_centroid_distance,
+                                                    affine2, resample_cache_dir, fallback_distance,
+                                                    return_provenance=True, mode=mapping_mode, return_scores=True)
+    backward, provenance_backward, match_scores_backward = map_regions(image2_labels, image1_labels, affine2,
+                                                                       max_centroid_distance, affine1,
+                                                                       resample_cache_dir, fallback_distance,
+                                                                       return_provenance=True, mode=mapping_mode,
+                                                                       return_scores=True)
+    return {'forward': forward, 'backward': backward,
+            'provenance': provenance, 'provenance_backward': provenance_backward,
+            'match_scores': match_scores, 'match_scores_backward': match_scores_backward}
+
+
+def stage_change(inputs, resample_cache_dir):
+    """
+    Compute the voxel-wise difference between both lesion masks, in the first image's grid.
+
+    :return: Difference volume (see compute_difference_volume).
+    """
+    volumes = inputs['load']
+    (mask1, affine1), (mask2, affine2) = volumes['mask1'], volumes['mask2']
+    if needs_resampling(mask1.shape, affine1, mask2.shape, affine2):
+        mask2 = resample_to_reference(mask2, affine2, mask1.shape, affine1, cache_dir=resample_cache_dir)
+    return compute_difference_volume(mask1, mask2)
+
+
+def stage_render(inputs, montage_columns, montage_tiles_per_page, montage_tile_size, montage_margin):
+    """
+    Render the figures used by the report: labels with mapping, difference and lesion montages.
+
+    :return: List of the written image files.
+    """
+    volumes = inputs['load']
+    image1_labels, image2_labels = inputs['label']
+    image1_properties, image2_properties = inputs['properties']
+    image1_data, image2_data = volumes['mask1'][0], volumes['mask2'][0]
+    difference_volume = inputs['change']
+
+    slice_index = image1_data.shape[2] // 2
+    plot_labeled_regions_with_mapping(image1_data, image1_labels, image2_data, image2_labels,
+                                      inputs['map']['forward'], slice_index, show=False)
+    plot_difference_slice(image1_data, image2_data, difference_volume, slice_index, show=False)
+
+    files = ['output/labels_lesions.png', 'output/difference_lesions.png']
+    for out_number, background, labels, properties in ((1, volumes['background1'][0], image1_labels, image1_properties),
+                                                       (2, volumes['background2'][0], image2_labels, image2_properties)):
+        pages = plot_lesion_montage(background, labels, properties, out_number, tile_size=montage_tile_size,
+                                    columns=montage_columns, tiles_per_page=montage_tiles_per_page,
+                                    margin=montage_margin)
+        files += [f'lesions_out/lesions_{out_number}/{page}' for page in pages]
+        files.append(f'lesions_out/lesions_{out_number}/montage_index.json')
+    return files
+
+
+def stage_report(inputs, json_filename, pdf_filename):
+    """
+    Save the mapping log and generate the PDF report.
+
+    :return: List of the written files.
+    """
+    image1_labels, image2_labels = inputs['label']
+    mapping = inputs['map']
+    save_mapping_data_to_json(mapping['forward'], mapping['backward'], None, None, image1_labels, image2_labels,
+                              json_filename, mapping['provenance'], mapping['provenance_backward'],
+                              mapping['match_scores'], mapping['match_scores_backward'])
+    generate_pdf(load_data(json_filename), pdf_filename, 'output/labels_lesions.png', 'output/difference_lesions.png')
+    return [json_filename, pdf_filename]
+
+
+# Stage name, function, upstream stages and parameter names, in execution order
+STAGES = [
+    ('load', stage_load, [], ['subject']),
+    ('label', stage_label, ['load'], ['threshold_ratio']),
+    ('properties', stage_properties, ['load', 'label'], []),
+    ('map', stage_map, ['load', 'label'], ['max_centroid_distance', 'fallback_distance', 'mapping_mode',
+                                           'resample_cache_dir']),
+    ('change', stage_change, ['load'], ['resample_cache_dir']),
+    ('render', stage_render, ['load', 'label', 'properties', 'change', 'map'], ['montage_columns',
+                                                                                'montage_tiles_per_page',
+                                                                                'montage_tile_size',
+                                                                                'montage_margin']),
+    ('report', stage_report, ['label', 'map', 'render'], ['json_filename', 'pdf_filename']),
+]
+
+# Modules whose code each stage runs; editing one invalidates the stage and its downstream stages
+STAGE_MODULES = {
+    'load': [utils],
+    'label': [utils],
+    'properties': [utils],
+    'map': [utils],
+    'change': [utils],
+    'render': [utils, visualisation],
+    'report': [utils, report_generation],
+}
+
+# Stages whose output is not cached to disk: reloading the NIfTI files is as fast as unpickling them
+UNCACHED_STAGES = {'load'}
+# Stages whose output is a list of written files, rerun if one of them is missing
+FILE_STAGES = {'render', 'report'}
+
+
+def file_fingerprint(path):
+    """
+    Identify the content of an input file by its path, size and modification time.
+
+    :param path: Path to the file.
+    :return: List describing the file.
+    """
+    stat = os.stat(path)
+    return [path, stat.st_size, stat.st_mtime_ns]
+
+
+def code_fingerprint(name, function):
+    """
+    Hash the code a stage runs: its stage function and the modules it depends on.
+
+    :param name: Name of the stage.
+    :param function: Stage function.
+    :return: Hexadecimal digest string.
+    """
+    digest = hashlib.sha1(inspect.getsource(function).encode())
+    for module in STAGE_MODULES[name]:
+        digest.update(inspect.getsource(module).encode())
+    return digest.hexdigest()
+
+
+def stage_fingerprints(subject, parameters):
+    """
+    Compute the fingerprint of every stage from its code, its parameters and the fingerprints of its upstream stages.
+
+    Fingerprints only depend on the inputs, so they are known before running anything.
+
+    :param subject: Dictionary mapping a volume name to its NIfTI path.
+    :param parameters: Dictionary of stage parameters.
+    :return: Dictionary mapping each stage name to its fingerprint.
+    """
+    values = dict(parameters, subject=subject)
+    fingerprints = {}
+    for name, function, upstream, parameter_names in STAGES:
+        description = {'stage': name,
+                       'code': code_fingerprint(name, function),
+                       'parameters': {key: values[key] for key in parameter_names},
+                       'upstream': [fingerprints[stage] for stage in upstream]}
+        if name == 'load':
+            description['files'] = {key: file_fingerprint(path) for key, path in sorted(subject.items())}
+        encoded = json.dumps(description, sort_keys=True, default=str).encode()
+        fingerprints[name] = hashlib.sha1(encoded).hexdigest()
+    return fingerprints
+
+
+def prepare_output_dirs():
+    """
+    Create the output directories the stages write to, relative to the working directory.
+    """
+    for directory in ('output', 'lesions_out/lesions_1', 'lesions_out/lesions_2'):
+        os.makedirs(directory, exist_ok=True)
+
+
+def run_pipeline(subject=SUBJECT, parameters=PARAMETERS, cache_dir='output/cache/stages', force=(), volumes=None):
+    """
+    Run the stage DAG, executing only the stages whose inputs or parameters changed and their downstream stages.
+
+    Each executed stage records its fingerprint in cache_dir/manifest.json and, unless uncached,
+    pickles its output to cache_dir/<stage>.pkl. Outputs of valid stages are only loaded from
+    the cache when a downstream stage needs to run.
+
+    :param subject: Dictionary mapping a volume name to its NIfTI path.
+    :param parameters: Dictionary of stage parameters.
+    :param cache_dir: Directory where the stage outputs and the manifest are stored.
+    :param force: Names of stages to rerun even if they are up to date.
+    :param volumes: Volumes of the subject already loaded (see load_subject_volumes), used as output of the load stage.
+    :return: List of the names of the stages that were executed.
+    """
+    prepare_output_dirs()
+    os.makedirs(cache_dir, exist_ok=True)
+    manifest_filename = os.path.join(cache_dir, 'manifest.json')
+    manifest = load_data(manifest_filename) if os.path.exists(manifest_filename) else {}
+    fingerprints = stage_fingerprints(subject, parameters)
+    stages = {name: (function, upstream, parameter_names) for name, function, upstream, parameter_names in STAGES}
+
+    def output_path(name):
+        return os.path.join(cache_dir, f'{name}.pkl')
+
+    def is_valid(name):
+        if name in force or manifest.get(name) != fingerprints[name]:
+            return False
+        if name not in UNCACHED_STAGES and not os.path.exists(output_path(name)):
+            return False
+        # Stages producing files are invalid if one of them was removed
+        if name in FILE_STAGES:
+            with open(output_path(name), 'rb') as file:
+                return all(os.path.exists(path) for path in pickle.load(file))
+        return True
+
+    # Invalid stages and everything downstream of them need to run
+    to_run = []
+    for name, (_, upstream, _) in stages.items():
+        if not is_valid(name) or any(stage in to_run for stage in upstream):
+            to_run.append(name)
+
+    values = dict(parameters, subject=subject)
+    outputs = {'load': volumes} if volumes is not None else {}
+
+    def execute(name):
+        function, upstream, parameter_names = stages[name]
+        return function({stage: get_output(stage) for stage in upstream},
+                        **{key: values[key] for key in parameter_names})
+
+    def get_output(name):
+        if name not in outputs:
+            if name in to_run or name in UNCACHED_STAGES:
+                outputs[name] = execute(name)
+            else:
+                with open(output_path(name), 'rb') as file:
+                    outputs[name] = pickle.load(file)
+        return outputs[name]
+
+    for name in to_run:
+        print(f'Running stage {name}')
+        get_output(name)
+        if name not in UNCACHED_STAGES:
+            with open(output_path(name), 'wb') as file:
+                pickle.dump(outputs[name], file)
+        manifest[name] = fingerprints[name]
+        with open(manifest_filename, 'w') as outfile:
+            json.dump(manifest, outfile, indent=4)
+
+    skipped = [name for name in stages if name not in to_run]
+    if skipped:
+        print('Up to date, skipped:', ', '.join(skipped))
+    return to_run
+
+
+def run_batch(subjects, output_dirs, parameters=PARAMETERS, max_prefetch=1, force=()):
+    """
+    Run the pipeline for several subjects, loading the next subjects while the current one is processed.
+
+    Each subject runs in its own output directory, which holds its figures, report and stage cache.
+
+    :param subjects: List of dictionaries mapping a volume name to its NIfTI path.
+    :param output_dirs: Output directory of each subject.
+    :param parameters: Dictionary of stage parameters.
+    :param max_prefetch: Maximum number of loaded subjects waiting to be processed (see prefetch_subjects).
+    :param force: Names of stages to rerun even if they are up to date.
+    :return: Dictionary mapping each output directory to the names of the stages executed for it.
+    """
+    if len(subjects) != len(output_dirs):
+        raise ValueError("One output directory is required per subject")
+    # Paths are made absolute since the working directory changes while the next subjects are loaded
+    subjects = [{key: os.path.abspath(path) for key, path in subject.items()} for subject in subjects]
+    output_dirs = [os.path.abspath(output_dir) for output_dir in output_dirs]
+    working_dir = os.getcwd()
+    executed = {}
+    try:
+        for output_dir, (subject, volumes) in zip(output_dirs, prefetch_subjects(subjects, max_prefetch)):
+            print(f'Subject {output_dir}')
+            os.makedirs(output_dir, exist_ok=True)
+            os.chdir(output_dir)
+            executed[output_dir] = run_pipeline(subject, parameters, force=force, volumes=volumes)
+            os.chdir(working_dir)
+    finally:
+        os.chdir(working_dir)
+    return executed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the lesion tracking stages that are out of date.")
+    parser.add_argument('--force', nargs='+', default=[], choices=[name for name, *_ in STAGES], metavar='STAGE',
+                        help="stages to rerun even if they are up to date (their downstream stages rerun too)")
+    parser.add_argument('--subjects', help="JSON file with a list of subjects, each one a dictionary with the four "
+                                           "volume paths and an 'output_dir'; runs them as a batch")
+    args = parser.parse_args()
+
+    if args.subjects is None:
+        run_pipeline(force=args.force)
+        return
+    subjects = load_data(args.subjects)
+    output_dirs = [subject.pop('output_dir') for subject in subjects]
+    run_batch(subjects, output_dirs, force=args.force)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,466 @@
+import sys
+import threading
+from collections import Counter
+from functools import partial
+import time
+import tracemalloc
+
+import numpy as np
+from scipy import ndimage
+
+from utils import (find_and_label_regions, find_and_label_regions_sweep, compute_region_properties, map_regions,
+                   prefetch_subjects)
+
+
+# Maximum ratio of the time and of the peak memory of a candidate over the reference implementation: the frozen
+# reference for labeling and mapping (same algorithm as the original), the current function for the properties
+BUDGETS = {
+    'label': (1.5, 1.5),
+    'properties': (1.5, 1.5),
+    'map': (1.5, 1.5),
+    # Against one find_and_label_regions call per ratio: the sweep must be clearly faster
+    'sweep': (0.75, 1.5),
+}
+# Absolute ceilings of the time (seconds) and peak memory (MB) of each stage on the default synthetic cases,
+# so that a slowdown of the current functions themselves also fails; the times leave room for noisy machines
+CEILINGS = {
+    'label': (0.015, 4.0),
+    'properties': (0.025, 5.5),
+    'map': (0.1, 3.5),
+    'sweep': (0.3, 55.0),
+}
+# Timings are the best of several runs; differences below the timer resolution are ignored
+TIMING_REPEATS = 5
+TIMING_RESOLUTION = 2e-3
+
+
+def make_synthetic_case(seed=0, shape=(96, 96, 64), num_lesions=150):
+    """
+    Build a reproducible pair of lesion masks with lesions that persist, shift, grow, vanish or appear.
+
+    :param seed: Seed of the random generator.
+    :param shape: Shape of the volumes.
+    :param num_lesions: Number of lesions at the first time point.
+    :return: Lesion masks (float arrays of 0 and 1) of the first and second time points.
+    """
+    rng = np.random.default_rng(seed)
+    grid = np.indices(shape)
+    mask1 = np.zeros(shape, dtype=bool)
+    mask2 = np.zeros(shape, dtype=bool)
+    centers = rng.uniform(4, np.array(shape) - 4, size=(num_lesions, 3))
+    radii = rng.uniform(1, 3.5, size=num_lesions)
+    # 0: unchanged, 1: shifted, 2: grown, 3: disappeared
+    fates = rng.choice(4, size=num_lesions, p=[0.4, 0.3, 0.2, 0.1])
+    for center, radius, fate in zip(centers, radii, fates):
+        low = np.maximum(np.floor(center - radius - 3).astype(int), 0)
+        high = np.minimum(np.ceil(center + radius + 3).astype(int) + 1, shape)
+        window = tuple(slice(lo, hi) for lo, hi in zip(low, high))
+        distance = np.sqrt(sum((grid[axis][window] - center[axis]) ** 2 for axis in range(3)))
+        mask1[window] |= distance <= radius
+        if fate == 0:
+            mask2[window] |= distance <= radius
+        elif fate == 1:
+            shifted = np.sqrt(sum((grid[axis][window] - center[axis] - shift) ** 2
+                                  for axis, shift in enumerate(rng.uniform(-1.5, 1.5, size=3))))
+            mask2[window] |= shifted <= radius
+        elif fate == 2:
+            mask2[window] |= distance <= radius + 1
+    # New lesions at the second time point
+    new_voxels = rng.integers(2, np.array(shape) - 2, size=(num_lesions // 10, 3))
+    mask2[tuple(new_voxels.T)] = True
+    mask2 = ndimage.binary_dilation(mask2 & ~ndimage.binary_dilation(mask1, iterations=2)) | mask2
+    return mask1.astype(float), mask2.astype(float)
+
+
+def reference_region_labels(image_data, threshold_ratio=0.5):
+    """
+    Original implementation of find_and_label_regions, kept as a reference.
+
+    :param image_data: Numpy array of the image data.
+    :param threshold_ratio: Ratio of the maximum intensity used as threshold.
+    :return: Labeled image array, number of features.
+    """
+    binary_image = image_data > image_data.max() * threshold_ratio
+    return ndimage.label(binary_image, structure=np.ones((3, 3, 3), dtype=int))
+
+
+def reference_region_mapping(image1_labels, image2_labels):
+    """
+    Original greedy implementation of map_regions, kept as a reference: each region of image1 is mapped
+    to the region of image2 it overlaps most.
+
+    :param image1_labels: Labeled regions of the first image.
+    :param image2_labels: Labeled regions of the second image.
+    :return: Dictionary mapping region IDs from image1 to region IDs in image2 (or None).
+    """
+    mapping = {}
+    for region1_id in np.unique(image1_labels)[1:]:  # Skip the background
+        region2_ids, counts = np.unique(image2_labels[image1_labels == region1_id], return_counts=True)
+        counts, region2_ids = counts[region2_ids != 0], region2_ids[region2_ids != 0]
+        mapping[region1_id] = region2_ids[np.argmax(counts)] if len(counts) else None
+    return mapping
+
+
+def reference_region_properties(labeled_image):
+    """
+    Original per-region implementation of the center and volume, kept as a reference.
+
+    :param labeled_image: Labeled image array.
+    :return: Dictionary mapping each region ID to its center and volume.
+    """
+    properties = {}
+    for region_id in np.unique(labeled_image)[1:]:  # Skip the background
+        indices = np.where(labeled_image == region_id)
+        center = np.mean(indices, axis=1)
+        volume = len(indices[0])
+        properties[region_id] = {'center': center, 'volume': volume}
+    return properties
+
+
+def compare_labels(reference, candidate):
+    """
+    Compare two (labeled image, number of features) results.
+
+    :return: List of mismatch descriptions, empty if identical.
+    """
+    mismatches = []
+    if reference[1] != candidate[1]:
+        mismatches.append(f"number of regions {candidate[1]} instead of {reference[1]}")
+    if reference[0].shape != candidate[0].shape or not np.array_equal(reference[0], candidate[0]):
+        mismatches.append("labeled images differ")
+    return mismatches
+
+
+def compare_properties(reference, candidate, atol=1e-6):
+    """
+    Compare the properties shared by two region property dictionaries.
+
+    :param atol: Absolute tolerance on floating point values.
+    :return: List of mismatch descriptions, empty if identical.
+    """
+    if set(reference) != set(candidate):
+        return [f"regions {sorted(set(reference) ^ set(candidate))} are not in both results"]
+    mismatches = []
+    for region_id, properties in reference.items():
+        for key in properties.keys() & candidate[region_id].keys():
+            value, other = properties[key], candidate[region_id][key]
+            if isinstance(value, tuple):
+                equal = value == other
+            else:
+                equal = np.allclose(value, other, rtol=0, atol=atol)
+            if not equal:
+                mismatches.append(f"region {region_id} {key}: {other} instead of {value}")
+    return mismatches
+
+
+def compare_mappings(reference, candidate, shared_targets=True):
+    """
+    Compare two region mappings.
+
+    :param shared_targets: If False, regions whose reference target is shared with another region are
+                           skipped, for one-to-one candidates which must give that target to one region only.
+    :return: List of mismatch descriptions, empty if identical.
+    """
+    if set(reference) != set(candidate):
+        return [f"regions {sorted(set(reference) ^ set(candidate))} are not in both mappings"]
+    target_counts = Counter(reference.values())
+    return [f"region {region_id} maps to {candidate[region_id]} instead of {mapped_id}"
+            for region_id, mapped_id in reference.items() if candidate[region_id] != mapped_id
+            and (shared_targets or mapped_id is None or target_counts[mapped_id] == 1)]
+
+
+def time_call(function, *args, repeats=TIMING_REPEATS):
+    """
+    Measure the wall time of a function, without memory tracing which would slow it down.
+
+    :param repeats: Number of runs; the fastest one is kept to reduce noise.
+    :return: Result of the last run and the best elapsed time (seconds).
+    """
+    best = np.inf
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = function(*args)
+        best = min(best, time.perf_counter() - start)
+    return result, best
+
+
+def peak_memory(function, *args):
+    """
+    Measure the peak Python/NumPy memory allocated by a function in a separate run.
+
+    :return: Peak memory (MB).
+    """
+    tracemalloc.start()
+    try:
+        function(*args)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return peak / 2 ** 20
+
+
+def check_budget(stage, reference_function, candidate_function, args, budgets=BUDGETS, ceilings=CEILINGS):
+    """
+    Time and trace a candidate implementation and the reference on the same input, and check the
+    candidate against the budget of its stage, relative to the reference, and against its absolute ceiling.
+
+    :return: Result of the candidate and list of budget violations, empty if within budget.
+    """
+    max_time_ratio, max_memory_ratio = budgets[stage]
+    max_time, max_memory = ceilings[stage]
+    _, reference_time = time_call(reference_function, *args)
+    candidate, candidate_time = time_call(candidate_function, *args)
+    violations = []
+    if candidate_time > max_time_ratio * reference_time + TIMING_RESOLUTION:
+        violations.append(f"{stage} took {candidate_time * 1000:.1f} ms, reference {reference_time * 1000:.1f} ms "
+                          f"(budget {max_time_ratio}x)")
+    if candidate_time > max_time:
+        violations.append(f"{stage} took {candidate_time * 1000:.1f} ms (ceiling {max_time * 1000:.0f} ms)")
+    reference_memory = peak_memory(reference_function, *args)
+    candidate_memory = peak_memory(candidate_function, *args)
+    if candidate_memory > max_memory_ratio * reference_memory:
+        violations.append(f"{stage} used {candidate_memory:.1f} MB, reference {reference_memory:.1f} MB "
+                          f"(budget {max_memory_ratio}x)")
+    if candidate_memory > max_memory:
+        violations.append(f"{stage} used {candidate_memory:.1f} MB (ceiling {max_memory} MB)")
+    return candidate, violations
+
+
+def run_candidate(stage, reference_function, candidate_function, args, budgets, ceilings=CEILINGS):
+    """
+    Run a candidate implementation, checking its budget against the reference unless budgets is None.
+
+    :return: Result of the candidate and list of budget violations.
+    """
+    if budgets is None:
+        return candidate_function(*args), []
+    return check_budget(stage, reference_function, candidate_function, args, budgets, ceilings)
+
+
+def check_implementations(label_function=find_and_label_regions, properties_function=compute_region_properties,
+                          map_function=map_regions, one_to_one=False, seeds=(0, 1, 2), budgets=BUDGETS,
+                          ceilings=CEILINGS, **case_options):
+    """
+    Compare implementations against the frozen reference functions on seeded synthetic cases, and check
+    the time and memory of each stage against the reference on the same run (see BUDGETS) and against the
+    absolute ceilings.
+
+    :param label_function: Implementation of find_and_label_regions to check.
+    :param properties_function: Implementation of compute_region_properties to check.
+    :param map_function: Implementation of map_regions to check.
+    :param one_to_one: If True, map_function is a one-to-one matching, only compared on the regions whose
+                       reference target is not shared (see compare_mappings).
+    :param seeds: Seeds of the synthetic cases.
+    :param budgets: Dictionary mapping each stage to its maximum (time, memory) ratio over the reference,
+                    or None to skip budgets.
+    :param ceilings: Dictionary mapping each stage to its maximum (time, memory), sized to the default
+                     synthetic cases, or None to skip them (e.g. with other case options).
+    :param case_options: Extra arguments of make_synthetic_case.
+    :return: List of failure descriptions, empty if everything matches.
+    """
+    if ceilings is None:
+        ceilings = {stage: (np.inf, np.inf) for stage in BUDGETS}
+    failures = []
+    for seed in seeds:
+        mask1, mask2 = make_synthetic_case(seed, **case_options)
+        labels = []
+        for mask in (mask1, mask2):
+            reference = reference_region_labels(mask)
+            candidate, violations = run_candidate('label', reference_region_labels, label_function, (mask,), budgets,
+                                                  ceilings)
+            failures += [f"seed {seed} label: {m}" for m in compare_labels(reference, candidate) + violations]
+            labels.append(reference[0])
+
+        for image_labels in labels:
+            candidate, violations = run_candidate('properties', compute_region_properties, properties_function,
+                                                  (image_labels,), budgets, ceilings)
+            failures += [f"seed {seed} properties: {v}" for v in violations]
+            # Pinned against the original per-region loop and the current physical-space metrics
+            for reference in (reference_region_properties(image_labels), compute_region_properties(image_labels)):
+                failures += [f"seed {seed} properties: {m}" for m in compare_properties(reference, candidate)]
+
+        for first, second in ((labels[0], labels[1]), (labels[1], labels[0])):
+            reference = reference_region_mapping(first, second)
+            candidate, violations = run_candidate('map', reference_region_mapping, map_function, (first, second),
+                                                  budgets, ceilings)
+            failures += [f"seed {seed} map: {m}"
+                         for m in compare_mappings(reference, candidate, not one_to_one) + violations]
+    return failures
+
+
+def sweep_label_regions(image_data, threshold_ratio=0.5):
+    """
+    Label an image with find_and_label_regions_sweep over a single ratio, as a label implementation.
+
+    :return: Labeled image array, number of features.
+    """
+    return find_and_label_regions_sweep(image_data, [threshold_ratio])[threshold_ratio]
+
+
+def make_grayscale_volume(seed=0, shape=(64, 64, 48), sigma=2.0):
+    """
+    Build a reproducible smoothed random field, whose components split and merge across thresholds.
+
+    :param seed: Seed of the random generator.
+    :param shape: Shape of the volume.
+    :param sigma: Standard deviation of the Gaussian smoothing, in voxels.
+    :return: Float array of the volume.
+    """
+    rng = np.random.default_rng(seed)
+    return ndimage.gaussian_filter(rng.random(shape), sigma)
+
+
+def label_each_ratio(image_data, threshold_ratios):
+    """
+    Label an image separately for each threshold ratio, the reference of find_and_label_regions_sweep.
+
+    :return: Dictionary mapping each ratio to (labeled image array, number of features).
+    """
+    return {ratio: find_and_label_regions(image_data, ratio) for ratio in threshold_ratios}
+
+
+def check_threshold_sweep(seeds=(0, 1), threshold_ratios=np.linspace(0.84, 0.98, 15),
+                          budget_ratios=np.linspace(0.5, 0.98, 50), budgets=BUDGETS):
+    """
+    Check every ratio of a multi-ratio find_and_label_regions_sweep against find_and_label_regions
+    on grayscale volumes; over these ratios the component count rises then falls as components merge.
+    The time and memory of a sweep over many ratios are checked against labeling each ratio separately.
+
+    :param seeds: Seeds of the grayscale volumes.
+    :param threshold_ratios: Ratios swept in a single call.
+    :param budget_ratios: Ratios of the sweep whose time and memory are checked.
+    :param budgets: Dictionary of the stage budgets (see BUDGETS), or None to skip the budget.
+    :return: List of failure descriptions, empty if every ratio matches.
+    """
+    failures = []
+    for seed in seeds:
+        image_data = make_grayscale_volume(seed)
+        sweep = find_and_label_regions_sweep(image_data, threshold_ratios)
+        counts = find_and_label_regions_sweep(image_data, threshold_ratios, return_labels=False)
+        for ratio in threshold_ratios:
+            reference = find_and_label_regions(image_data, ratio)
+            failures += [f"seed {seed} ratio {ratio:.2f}: {m}" for m in compare_labels(reference, sweep[ratio])]
+            if counts[ratio] != reference[1]:
+                failures.append(f"seed {seed} ratio {ratio:.2f}: count {counts[ratio]} instead of {reference[1]}")
+    if budgets is not None:
+        _, violations = check_budget('sweep', label_each_ratio, find_and_label_regions_sweep,
+                                     (make_grayscale_volume(seeds[0]), budget_ratios), budgets)
+        failures += violations
+    return failures
+
+
+def check_distance_fallback_one_to_one():
+    """
+    Check that the distance fallback never gives the same region of image2 to several regions of image1.
+
+    Two lesions of image1 sit 5 to 8 voxels away from a single lesion of image2, without overlap.
+
+    :return: List of failure descriptions, empty if the fallback stays one-to-one.
+    """
+    image1_labels = np.zeros((40, 40, 40), dtype=np.int32)
+    image2_labels = np.zeros_like(image1_labels)
+    image1_labels[10:13, 10:13, 10:13] = 1
+    image1_labels[23:26, 10:13, 10:13] = 2
+    image2_labels[17:20, 10:13, 10:13] = 1
+    failures = []
+    for fallback_mode in ('centroid', 'surface'):
+        for mode in ('greedy', 'assignment'):
+            mapping, provenance = map_regions(image1_labels, image2_labels, fallback_distance=20,
+                                              fallback_mode=fallback_mode, return_provenance=True, mode=mode)
+            targets = [mapped_id for mapped_id in mapping.values() if mapped_id is not None]
+            if len(targets) != len(set(targets)) or len(targets) != 1:
+                failures.append(f"{fallback_mode} fallback with {mode} mode gave {mapping}")
+            if list(provenance.values()).count('distance') != 1:
+                failures.append(f"{fallback_mode} fallback with {mode} mode gave provenance {provenance}")
+    return failures
+
+
+def check_prefetch_subjects(max_prefetch=2):
+    """
+    Check the ordering, error propagation, memory bound, early-exit shutdown and queue size validation of
+    prefetch_subjects.
+
+    :param max_prefetch: Queue size used for the checks.
+    :return: List of failure descriptions, empty if the prefetcher behaves.
+    """
+    failures = []
+    rng = np.random.default_rng(0)
+    delays = rng.uniform(0, 0.01, size=12)
+    loaded, consumed = [], []
+    in_memory = []
+
+    def loader(subject):
+        if subject == 'broken':
+            raise IOError("cannot read subject")
+        time.sleep(delays[subject])
+        loaded.append(subject)
+        # Subjects loaded but not yet handed over plus the one being processed
+        in_memory.append(len(loaded) - len(consumed))
+        return subject * 10
+
+    for subject, volumes in prefetch_subjects(range(12), max_prefetch, loader):
+        consumed.append(subject)
+        if volumes != subject * 10:
+            failures.append(f"subject {subject} received the volumes of another subject")
+        time.sleep(0.005)
+    if consumed != list(range(12)):
+        failures.append(f"subjects yielded in order {consumed}")
+    if max(in_memory) > max_prefetch + 2:
+        failures.append(f"{max(in_memory)} subjects in memory (bound {max_prefetch + 2})")
+
+    consumed = []
+    try:
+        for subject, _ in prefetch_subjects([0, 1, 'broken', 3], max_prefetch, loader):
+            consumed.append(subject)
+        failures.append("loader error was not raised")
+    except IOError:
+        if consumed != [0, 1]:
+            failures.append(f"subjects before the error were {consumed}")
+
+    loaded.clear()
+    threads_before = threading.active_count()
+    for _ in prefetch_subjects(range(12), max_prefetch, loader):
+        break
+    time.sleep(0.05)
+    if threading.active_count() != threads_before:
+        failures.append("loader thread still running after the consumer stopped")
+    if len(loaded) > max_prefetch + 2:
+        failures.append(f"{len(loaded)} subjects loaded after stopping at the first one")
+
+    # A queue size of 0 would be unbounded
+    for invalid in (0, -1):
+        try:
+            prefetch_subjects(range(12), invalid, loader)
+            failures.append(f"max_prefetch={invalid} was accepted")
+        except ValueError:
+            pass
+    return failures
+
+
+def main():
+    # Implementations checked against the frozen reference functions
+    checks = {
+        'current functions': {},
+        'sweep labeling': {'label_function': sweep_label_regions},
+        'one-to-one mapping': {'map_function': partial(map_regions, mode='assignment', score='overlap'),
+                               'one_to_one': True},
+    }
+    # Checks of specific behaviours, each returning a list of failures
+    standalone_checks = {
+        'threshold sweep labeling': check_threshold_sweep,
+        'one-to-one distance fallback': check_distance_fallback_one_to_one,
+        'subject prefetching': check_prefetch_subjects,
+    }
+    failed = False
+    results = [(name, lambda implementations=implementations: check_implementations(**implementations))
+               for name, implementations in checks.items()] + list(standalone_checks.items())
+    for name, check in results:
+        failures = check()
+        print(f"{name}: {'OK' if not failures else 'FAILED'}")
+        for failure in failures:
+            print('   ', failure)
+        failed |= bool(failures)
+    return 1 if failed else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -12,6 +12,33 @@ def load_data(filename):
         data = json.load(file)
     return data
 
+# Draw the lesion montages of one time point, listing the lesion IDs of each page
+def draw_lesion_montages(c, y_position, montage_directory, time_point):
+    index_filename = os.path.join(montage_directory, 'montage_index.json')
+    if not os.path.exists(index_filename):
+        return y_position
+    montage_index = load_data(index_filename)
+
+    for page_name, lesion_ids in montage_index['pages'].items():
+        c.showPage()
+        y_position = 750
+        c.drawString(100, y_position, f"Lesions at time point {time_point} ({page_name}), tiles left to right:")
+        y_position -= 20
+        ids_text = ", ".join(str(lesion_id) for lesion_id in lesion_ids)
+        # Wrap the list of IDs over several lines
+        line_length = 90
+        for start in range(0, len(ids_text), line_length):
+            c.drawString(100, y_position, ids_text[start:start + line_length])
+            y_position -= 15
+        image = ImageReader(os.path.join(montage_directory, page_name))
+        width, height = image.getSize()
+        draw_width = 500
+        draw_height = min(draw_width * height / width, y_position - 50)
+        draw_width = draw_height * width / height
+        c.drawImage(image, 50, y_position - draw_height, width=draw_width, height=draw_height)
+        y_position -= draw_height + 20
+    return y_position
+
 # Generate PDF report
 def generate_pdf(data, output_filename, image_filename1, image_filename2):
     c = canvas.Canvas(output_filename, pagesize=LETTER)
@@ -54,8 +81,13 @@ def generate_pdf(data, output_filename, image_filename1, image_filename2):
     # Forward mapping information
     c.drawString(100, y_position, "Forward Region Mapping (Initial to Second):")
     y_position -= line_height
+    provenance = data.get('match_provenance_forward', {})
+    match_scores = data.get('match_scores_forward', {})
     for key, value in data['region_mapping_forward'].items():
-        c.drawString(100, y_position, f"Region {key} maps to Region {value}")
+        matched_by = f" (matched by {provenance[key]})" if provenance.get(key) else ""
+        if key in match_scores:
+            matched_by += f" Dice {match_scores[key]['dice']:.2f}, IoU {match_scores[key]['iou']:.2f}"
+        c.drawString(100, y_position, f"Region {key} maps to Region {value}{matched_by}")
         y_position -= line_height
         if y_position < 50:
             c.showPage()
@@ -68,13 +100,22 @@ def generate_pdf(data, output_filename, image_filename1, image_filename2):
     # Backward mapping information
     c.drawString(100, y_position, "Backward Region Mapping (Second to Initial):")
     y_position -= line_height
+    provenance = data.get('match_provenance_backward', {})
+    match_scores = data.get('match_scores_backward', {})
     for key, value in data['region_mapping_backward'].items():
-        c.drawString(100, y_position, f"Region {key} maps to Region {value}")
+        matched_by = f" (matched by {provenance[key]})" if provenance.get(key) else ""
+        if key in match_scores:
+            matched_by += f" Dice {match_scores[key]['dice']:.2f}, IoU {match_scores[key]['iou']:.2f}"
+        c.drawString(100, y_position, f"Region {key} maps to Region {value}{matched_by}")
         y_position -= line_height
         if y_position < 50:
             c.showPage()
             y_position = 750
 
+    # Montages of all lesions, one or a few pages per time point
+    for time_point in (1, 2):
+        y_position = draw_lesion_montages(c, y_position, f'lesions_out/lesions_{time_point}', time_point)
+
     image_directory = 'lesions_out/'
 
     # Iterating over lesion images
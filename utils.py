@@ -1,22 +1,255 @@
 
 import nibabel as nib
 from scipy import ndimage
+from scipy.optimize import linear_sum_assignment
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+from scipy.spatial import cKDTree
+import hashlib
 import json
+import os
+import queue
+import threading
 import numpy as np
 
 
 
-def load_nifti_image(file_path):
+def load_nifti_image(file_path, return_affine=False):
     """
     Load a NIfTI image and return its data array.
 
     :param file_path: Path to the NIfTI file.
-    :return: Numpy array containing the image data.
+    :param return_affine: If True, also return the voxel-to-world affine (voxel sizes are derived
+                          from it, see voxel_sizes).
+    :return: Numpy array containing the image data, or (data, affine) if return_affine is True.
     """
     nifti_img = nib.load(file_path)
+    if return_affine:
+        return nifti_img.get_fdata(), nifti_img.affine
     return nifti_img.get_fdata()
 
 
+def load_subject_volumes(subject):
+    """
+    Load all the volumes of one subject with their affines (voxel sizes follow from voxel_sizes(affine)).
+
+    :param subject: Dictionary mapping a volume name (e.g. 'mask1', 'background2') to its NIfTI path.
+    :return: Dictionary mapping each volume name to (data, affine).
+    """
+    return {name: load_nifti_image(path, return_affine=True) for name, path in subject.items()}
+
+
+def prefetch_subjects(subjects, max_prefetch=1, loader=load_subject_volumes):
+    """
+    Iterate over subjects while the next ones are decompressed and decoded on a background thread.
+
+    Gzip decompression releases the GIL, so loading overlaps with the labeling and mapping of the
+    current subject. At most max_prefetch loaded subjects wait in the queue, so at most
+    max_prefetch + 2 subjects are in memory: the queued ones, one being loaded and one being processed.
+
+    :param subjects: Iterable of subjects, each one passed to loader (see load_subject_volumes).
+    :param max_prefetch: Maximum number of loaded subjects waiting to be processed, at least 1.
+    :param loader: Function loading the volumes of one subject.
+    :return: Generator of (subject, volumes) pairs, in the order of subjects.
+    :raises ValueError: If max_prefetch is below 1, which would make the queue unbounded.
+    """
+    # Checked here rather than in the generator so that the error is raised at the call
+    if max_prefetch < 1:
+        raise ValueError(f"max_prefetch must be at least 1, got {max_prefetch}")
+    return _prefetch_subjects(subjects, max_prefetch, loader)
+
+
+def _prefetch_subjects(subjects, max_prefetch, loader):
+    """
+    Generator behind prefetch_subjects, started at the first iteration.
+
+    :param subjects: Iterable of subjects passed to loader.
+    :param max_prefetch: Size of the queue of loaded subjects, at least 1.
+    :param loader: Function loading the volumes of one subject.
+    :return: Generator of (subject, volumes) pairs, in the order of subjects.
+    """
+    loaded = queue.Queue(maxsize=max_prefetch)
+    stop = threading.Event()
+    done = object()
+
+    def put(item):
+        # Give up when the consumer has stopped iterating
+        while not stop.is_set():
+            try:
+                loaded.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def worker():
+        try:
+            for subject in subjects:
+                if not put((subject, loader(subject), None)):
+                    return
+        except Exception as error:
+            put((None, None, error))
+            return
+        put(done)
+
+    thread = threading.Thread(target=worker, daemon=True)
+    thread.start()
+    try:
+        while True:
+            item = loaded.get()
+            if item is done:
+                break
+            subject, volumes, error = item
+            if error is not None:
+                raise error
+            yield subject, volumes
+    finally:
+        stop.set()
+        thread.join()
+
+
+def voxel_sizes(affine):
+    """
+    Compute the voxel sizes (mm) along each axis from a voxel-to-world affine.
+
+    :param affine: 4x4 affine matrix, or None for unit voxels.
+    :return: Numpy array of the three voxel sizes.
+    """
+    if affine is None:
+        return np.ones(3)
+    return np.sqrt(np.sum(np.asarray(affine)[:3, :3] ** 2, axis=0))
+
+
+def voxel_to_world(coords, affine):
+    """
+    Transform voxel coordinates to world (scanner) coordinates.
+
+    :param coords: Array of shape (N, 3) with voxel coordinates.
+    :param affine: 4x4 affine matrix, or None to return the coordinates unchanged.
+    :return: Array of shape (N, 3) with world coordinates in mm.
+    """
+    coords = np.asarray(coords, dtype=float).reshape(-1, 3)
+    if affine is None:
+        return coords
+    affine = np.asarray(affine)
+    return coords @ affine[:3, :3].T + affine[:3, 3]
+
+
+# Resampled volumes kept in memory, keyed by the fingerprint of their inputs
+_resample_cache = {}
+_RESAMPLE_CACHE_SIZE = 4
+# Maximum number of resampled volumes kept on disk in a cache directory (least recently used are removed)
+RESAMPLE_DISK_CACHE_SIZE = 8
+
+
+def _volume_fingerprint(data, *extra):
+    """
+    Build a hash identifying a volume and the parameters it is processed with.
+
+    :param data: Numpy array of the volume.
+    :param extra: Additional arrays or values (affines, shapes, interpolation order...).
+    :return: Hexadecimal digest string.
+    """
+    digest = hashlib.sha1()
+    digest.update(str((data.shape, data.dtype.str)).encode())
+    digest.update(np.ascontiguousarray(data).data)
+    for item in extra:
+        digest.update(np.asarray(item, dtype=float).tobytes() if item is not None else b'None')
+    return digest.hexdigest()
+
+
+def _cached_resampled_files(cache_dir):
+    """
+    List the resampled volumes stored in a cache directory, least recently used first.
+
+    :param cache_dir: Cache directory.
+    :return: List of file paths.
+    """
+    if not os.path.isdir(cache_dir):
+        return []
+    paths = [os.path.join(cache_dir, name) for name in os.listdir(cache_dir)
+             if name.startswith('resampled_') and name.endswith('.npy')]
+    return sorted(paths, key=os.path.getmtime)
+
+
+def clear_resample_cache(cache_dir=None, keep=0):
+    """
+    Remove cached resampled volumes from memory and from a cache directory.
+
+    :param cache_dir: Cache directory to clean, or None to only clear the in-memory cache.
+    :param keep: Number of most recently used files to keep on disk.
+    """
+    if keep == 0:
+        _resample_cache.clear()
+    if cache_dir is None:
+        return
+    paths = _cached_resampled_files(cache_dir)
+    for path in paths[:max(len(paths) - keep, 0)]:
+        os.remove(path)
+
+
+def resample_to_reference(data, affine, reference_shape, reference_affine, order=0, block_size=16, cache_dir=None,
+                          max_cached_files=RESAMPLE_DISK_CACHE_SIZE):
+    """
+    Resample a volume into the voxel grid of a reference image using the NIfTI affines.
+
+    The output is computed in slabs of block_size slices along the first axis to bound memory.
+    Use order=0 (nearest neighbour) for label volumes so that region IDs are preserved.
+    Results are cached in memory and, if cache_dir is given, on disk as .npy files; only the
+    max_cached_files most recently used files are kept (see also clear_resample_cache).
+
+    :param data: Numpy array of the volume to resample.
+    :param affine: Voxel-to-world affine of the volume.
+    :param reference_shape: Shape of the reference voxel grid.
+    :param reference_affine: Voxel-to-world affine of the reference image.
+    :param order: Spline interpolation order (0 for labels and binary masks).
+    :param block_size: Number of reference slices resampled at once.
+    :param cache_dir: Directory where resampled volumes are stored between runs.
+    :param max_cached_files: Maximum number of resampled volumes kept in cache_dir.
+    :return: Numpy array with the shape of the reference grid.
+    """
+    reference_shape = tuple(reference_shape)
+    key = _volume_fingerprint(data, affine, reference_shape, reference_affine, order)
+    if key in _resample_cache:
+        return _resample_cache[key]
+    cache_path = os.path.join(cache_dir, f'resampled_{key}.npy') if cache_dir is not None else None
+    if cache_path is not None and os.path.exists(cache_path):
+        resampled = np.load(cache_path)
+        os.utime(cache_path)  # Mark as recently used
+    else:
+        # Reference voxel -> world -> source voxel
+        transform = np.linalg.inv(affine) @ np.asarray(reference_affine)
+        matrix, offset = transform[:3, :3], transform[:3, 3]
+        resampled = np.zeros(reference_shape, dtype=data.dtype)
+        for start in range(0, reference_shape[0], block_size):
+            stop = min(start + block_size, reference_shape[0])
+            ndimage.affine_transform(data, matrix, offset=offset + matrix[:, 0] * start,
+                                     output_shape=(stop - start,) + reference_shape[1:],
+                                     output=resampled[start:stop], order=order, mode='constant', cval=0)
+        if cache_path is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+            np.save(cache_path, resampled)
+            clear_resample_cache(cache_dir, keep=max_cached_files)
+    if len(_resample_cache) >= _RESAMPLE_CACHE_SIZE:
+        _resample_cache.pop(next(iter(_resample_cache)))
+    _resample_cache[key] = resampled
+    return resampled
+
+
+def needs_resampling(shape1, affine1, shape2, affine2):
+    """
+    Check whether two volumes live on different voxel grids.
+
+    :return: True if the shapes or affines differ.
+    """
+    return tuple(shape1) != tuple(shape2) or not np.allclose(affine1, affine2)
+
+
+# Fraction of the volume above which a threshold of find_and_label_regions_sweep is labeled from scratch
+# rather than by merging its new voxels into the components of the previous threshold
+SWEEP_RELABEL_FRACTION = 0.03
+
+
 def find_and_label_regions(image_data, threshold_ratio=0.5):
     """
     Find and label connected white regions in a binary image.
@@ -31,54 +264,536 @@ def find_and_label_regions(image_data, threshold_ratio=0.5):
     labeled_image, num_features = ndimage.label(binary_image, structure=structure)
     return labeled_image, num_features
 
-def map_regions(image1_labels, image2_labels):
+def _find_roots(parent, nodes):
+    """
+    Find the root of each node of a union-find forest, compressing the paths of the queried nodes.
+
+    :param parent: Numpy array of the parent of each node (roots are their own parent), updated in place.
+    :param nodes: Numpy array of node IDs.
+    :return: Numpy array of the root of each node.
+    """
+    roots = parent[nodes]
+    while True:
+        grand_parents = parent[roots]
+        if np.array_equal(grand_parents, roots):
+            break
+        roots = grand_parents
+    parent[nodes] = roots
+    return roots
+
+
+def _merge_new_voxels(flat_labels, new_voxels, parent, num_ids, flat_offsets, first_voxel=None):
+    """
+    Add the voxels reached by a lower threshold to the labeled components, touching only these voxels.
+
+    Components are union-find trees of component IDs; the new voxels are linked to each other and to the
+    roots of their active neighbours, and each group joins its smallest root or becomes a new component.
+
+    :param flat_labels: Flat zero-padded labeled image holding a component ID per active voxel, updated in place.
+    :param new_voxels: Flat indices of the voxels that become active.
+    :param parent: Numpy array of the parent of each component ID, updated in place.
+    :param num_ids: Number of component IDs in use.
+    :param flat_offsets: Flat index offsets of the neighbours of a voxel.
+    :param first_voxel: Numpy array of the first voxel (raster order) of each root, updated in place, or None.
+    :return: Number of component IDs in use, number of new components and number of merged components.
+    """
+    base = num_ids + 1
+    size = base + len(new_voxels)
+    nodes = np.arange(base, size)
+    flat_labels[new_voxels] = nodes
+    existing_roots = np.zeros(size, dtype=np.int32)  # 0 for the background and the new voxels
+    existing_roots[1:base] = _find_roots(parent, np.arange(1, base))
+
+    # Smallest and largest existing roots around each new voxel; subtracting 1 as unsigned integers
+    # puts the background (0) after every root for the minimum
+    lowest = np.full(len(new_voxels), np.iinfo(np.uint32).max, dtype=np.uint32)
+    attached = np.zeros(len(new_voxels), dtype=np.int32)
+    for flat_offset in flat_offsets:
+        root = existing_roots[flat_labels[new_voxels + flat_offset]]
+        np.minimum(lowest, (root - 1).view(np.uint32), out=lowest)
+        np.maximum(attached, root, out=attached)
+    first, second = [nodes[attached != 0]], [attached[attached != 0]]
+    # Voxels touching several roots are linked to all of them
+    bridging = np.flatnonzero(lowest + np.uint32(1) != attached)
+    for flat_offset in flat_offsets:
+        root = existing_roots[flat_labels[new_voxels[bridging] + flat_offset]]
+        first.append(nodes[bridging][root != 0])
+        second.append(root[root != 0])
+    # Link new voxels to each other (along the forward offsets, once per pair), unless both already
+    # hang from the same root
+    for flat_offset in flat_offsets[flat_offsets > 0]:
+        neighbour = flat_labels[new_voxels + flat_offset] - base
+        voxel = np.flatnonzero(neighbour >= 0)
+        neighbour = neighbour[voxel]
+        linked = (attached[voxel] != attached[neighbour]) | (attached[voxel] == 0)
+        first.append(nodes[voxel[linked]])
+        second.append(nodes[neighbour[linked]])
+    first, second = np.concatenate(first), np.concatenate(second)
+    graph = coo_matrix((np.ones(len(first), dtype=bool), (first, second)), shape=(size, size))
+    num_groups, group = connected_components(graph, directed=False)
+
+    # Each group is represented by its smallest root, or by a new ID if it only holds new voxels
+    old_roots = np.flatnonzero(existing_roots[:base] == np.arange(base))[1:]
+    representative = np.full(num_groups, size)
+    np.minimum.at(representative, group[old_roots], old_roots)
+    new_groups = group[base:]
+    born = np.unique(new_groups[representative[new_groups] == size])
+    representative[born] = np.arange(base, base + len(born))
+    merged = old_roots[representative[group[old_roots]] != old_roots]
+    parent[merged] = representative[group[merged]]
+    flat_labels[new_voxels] = representative[new_groups]
+
+    if first_voxel is not None:
+        group_first_voxel = np.full(num_groups, flat_labels.size)
+        np.minimum.at(group_first_voxel, new_groups, new_voxels)
+        np.minimum.at(group_first_voxel, group[old_roots], first_voxel[old_roots])
+        touched = np.unique(new_groups)
+        first_voxel[representative[touched]] = group_first_voxel[touched]
+    return num_ids + len(born), len(born), len(merged)
+
+
+def find_and_label_regions_sweep(image_data, threshold_ratios, return_labels=True):
+    """
+    Find and label connected white regions for several threshold ratios in one pass.
+
+    Voxels are grouped once by the highest threshold they exceed. From the highest threshold down, the
+    voxels reached by each threshold are merged into the existing components (see _merge_new_voxels);
+    a threshold reaching more than SWEEP_RELABEL_FRACTION of the volume is labeled with ndimage.label
+    instead, which is then cheaper. The labels produced for each ratio are identical to
+    find_and_label_regions(image_data, ratio).
+
+    :param image_data: Numpy array of the image data (any numeric or boolean type).
+    :param threshold_ratios: Iterable of ratios of the maximum intensity to sweep.
+    :param return_labels: If False, only the number of features is computed for each ratio.
+    :return: Dictionary mapping each ratio to (labeled image array, number of features),
+             or to the number of features if return_labels is False.
+    """
+    maximum = image_data.max() if image_data.size else 0
+    ratios = sorted(set(threshold_ratios), key=lambda ratio: maximum * ratio, reverse=True)
+    if len(ratios) <= 1:
+        # Nothing to share between thresholds
+        return {ratio: find_and_label_regions(image_data, ratio) if return_labels
+                else find_and_label_regions(image_data, ratio)[1] for ratio in ratios}
+    thresholds = [maximum * ratio for ratio in ratios]
+    structure = np.ones((3, 3, 3), dtype=int)  # 3D connectivity
+
+    # Level at which each voxel reached below the highest threshold becomes active
+    reached = (image_data > thresholds[-1]) & ~(image_data > thresholds[0])
+    levels = len(ratios) - np.searchsorted(np.array(thresholds[::-1]), image_data[reached], side='left')
+    reached = np.flatnonzero(reached)
+    relabeled = np.bincount(levels, minlength=len(ratios)) > SWEEP_RELABEL_FRACTION * image_data.size
+    relabeled[0] = True
+
+    # Voxels of the merged levels, sorted by level, as flat indices of a zero-padded grid
+    # so that neighbours are plain offsets
+    padded_shape = tuple(n + 2 for n in image_data.shape)
+    merged_levels = ~relabeled[levels]
+    reached, levels = reached[merged_levels], levels[merged_levels]
+    order = np.argsort(levels.astype(np.min_scalar_type(len(ratios))), kind='stable')  # Radix sort
+    new_voxels = np.ravel_multi_index(tuple(axis + 1 for axis in np.unravel_index(reached[order], image_data.shape)),
+                                      padded_shape)
+    bounds = np.searchsorted(levels[order], np.arange(len(ratios) + 1), side='left')
+    del reached, levels, order
+    offsets = np.argwhere(structure) - 1
+    offsets = offsets[np.any(offsets != 0, axis=1)]
+    flat_offsets = offsets @ np.array([padded_shape[1] * padded_shape[2], padded_shape[2], 1])
+
+    labels = np.zeros(padded_shape, dtype=np.int32)
+    interior = labels[1:-1, 1:-1, 1:-1]
+    flat_labels = labels.reshape(-1)
+    results = {}
+    for level, (ratio, threshold) in enumerate(zip(ratios, thresholds)):
+        if relabeled[level]:
+            num_features = ndimage.label(image_data > threshold, structure=structure, output=interior)
+            # Component IDs, with room for the components that appear at the next merged levels
+            num_ids = num_features
+            parent = np.arange(num_ids + 1 + len(new_voxels) - bounds[level + 1])
+            first_voxel = None
+            results[ratio] = (interior.copy(), num_features) if return_labels else num_features
+            continue
+
+        if return_labels and first_voxel is None:
+            # First voxel of each component in raster order, to number the components like ndimage.label
+            active_voxels = np.flatnonzero(flat_labels)
+            first_voxel = np.full(len(parent), flat_labels.size)
+            np.minimum.at(first_voxel, flat_labels[active_voxels], active_voxels)
+            del active_voxels
+        level_voxels = new_voxels[bounds[level]:bounds[level + 1]]
+        if len(level_voxels):
+            num_ids, born, merged = _merge_new_voxels(flat_labels, level_voxels, parent, num_ids, flat_offsets,
+                                                      first_voxel if return_labels else None)
+            num_features += born - merged
+        if return_labels:
+            roots = _find_roots(parent, np.arange(num_ids + 1))
+            components = np.flatnonzero(roots == np.arange(num_ids + 1))[1:]
+            rank = np.zeros(num_ids + 1, dtype=np.int32)
+            rank[components[np.argsort(first_voxel[components])]] = np.arange(1, len(components) + 1)
+            results[ratio] = (rank[roots].take(interior), num_features)
+        else:
+            results[ratio] = num_features
+    return results
+
+
+def map_regions(image1_labels, image2_labels, affine=None, max_centroid_distance=None, image2_affine=None,
+                cache_dir=None, fallback_distance=None, fallback_mode='centroid', return_provenance=False,
+                mode='greedy', score='iou', return_scores=False):
     """
     Map regions from image1 to image2 based on the overlap of labeled regions.
 
+    Regions without any overlap can optionally be matched in a second pass to the nearest
+    unclaimed region of image2 (KD-tree search on centroids or surface voxels).
+
     :param image1_labels: Labeled regions of the first image.
     :param image2_labels: Labeled regions of the second image.
-    :return: Dictionary mapping region IDs from image1 to the closest region IDs in image2.
-    """
-    mapping = {}
-    #Assuming that when label = 0, it means it is the background in black
-    #np.unique provides a sorted list of the id's of the regions
-    for region1_id in np.unique(image1_labels)[1:]:  # Skip background
-        region1_mask = image1_labels == region1_id
-        overlapping_regions = image2_labels[region1_mask]
-
-        # Count occurrences of each region ID in the overlap area
-        region2_id, counts = np.unique(overlapping_regions, return_counts=True)
-
-        # Ignore background
-        valid_idx = np.where(region2_id != 0)
-        region2_id = region2_id[valid_idx]
-        counts = counts[valid_idx]
-
-        if len(counts) == 0:
-            # No corresponding region in image2
-            mapping[region1_id] = None
-        else:
-            # Map to the most overlapping region ID in image2
-            mapping[region1_id] = region2_id[np.argmax(counts)]
+    :param affine: Voxel-to-world affine of the first image, used for centroid distances.
+    :param max_centroid_distance: If set, overlapping matches whose world-space centroids are further
+                                  apart than this distance (mm) are rejected and mapped to None.
+    :param image2_affine: Affine of the second image. If given and the grids differ, image2_labels is
+                          resampled (nearest neighbour) into the first image's grid before matching.
+    :param cache_dir: Directory used to cache the resampled labels between runs.
+    :param fallback_distance: If set, unmatched regions are mapped to the nearest unclaimed region of
+                              image2 within this distance (mm).
+    :param fallback_mode: 'centroid' to measure centroid distances, 'surface' for nearest surface voxels.
+    :param return_provenance: If True, also return a dictionary telling for each region of image1
+                              whether it was matched by 'overlap', 'distance' or not at all (None).
+    :param mode: 'greedy' maps each region to its most overlapping region independently, 'assignment'
+                 solves a one-to-one matching maximising the total overlap score (see assign_regions).
+    :param score: Overlap score used by the assignment mode: 'overlap', 'iou' or 'dice'.
+    :param return_scores: If True, also return the overlap, Dice and IoU of every match, computed
+                          after alignment (see compute_match_scores).
+    :return: Dictionary mapping region IDs from image1 to the closest region IDs in image2, followed by
+             the provenance dictionary if return_provenance is True and the match scores if return_scores is True.
+    """
+    if image2_affine is not None and affine is None:
+        raise ValueError("The affine of the first image is required to align the second image")
+    if image2_affine is not None and needs_resampling(image1_labels.shape, affine, image2_labels.shape, image2_affine):
+        image2_labels = resample_to_reference(image2_labels, image2_affine, image1_labels.shape, affine,
+                                              order=0, cache_dir=cache_dir)
+    if mode == 'assignment':
+        mapping = assign_regions(image1_labels, image2_labels, score)
+    elif mode == 'greedy':
+        mapping = {}
+        #Assuming that when label = 0, it means it is the background in black
+        #np.unique provides a sorted list of the id's of the regions
+        for region1_id in np.unique(image1_labels)[1:]:  # Skip background
+            region1_mask = image1_labels == region1_id
+            overlapping_regions = image2_labels[region1_mask]
+
+            # Count occurrences of each region ID in the overlap area
+            region2_id, counts = np.unique(overlapping_regions, return_counts=True)
+
+            # Ignore background
+            valid_idx = np.where(region2_id != 0)
+            region2_id = region2_id[valid_idx]
+            counts = counts[valid_idx]
+
+            if len(counts) == 0:
+                # No corresponding region in image2
+                mapping[region1_id] = None
+            else:
+                # Map to the most overlapping region ID in image2
+                mapping[region1_id] = region2_id[np.argmax(counts)]
+    else:
+        raise ValueError(f"Unknown mapping mode: {mode}")
+
+    if max_centroid_distance is not None:
+        centroids1 = region_centroids_world(image1_labels, affine)
+        centroids2 = region_centroids_world(image2_labels, affine)
+        for region1_id, region2_id in mapping.items():
+            if region2_id is not None and np.linalg.norm(centroids1[region1_id] - centroids2[region2_id]) > max_centroid_distance:
+                mapping[region1_id] = None
+
+    provenance = {region_id: 'overlap' if mapped_id is not None else None for region_id, mapped_id in mapping.items()}
+
+    if fallback_distance is not None:
+        unmatched_ids = [region_id for region_id, mapped_id in mapping.items() if mapped_id is None]
+        claimed_ids = set(mapped_id for mapped_id in mapping.values() if mapped_id is not None)
+        candidate_ids = [region_id for region_id in np.unique(image2_labels)[1:] if region_id not in claimed_ids]
+        distance_matches = match_regions_by_distance(image1_labels, image2_labels, unmatched_ids, candidate_ids,
+                                                     fallback_distance, affine, fallback_mode)
+        for region_id, mapped_id in distance_matches.items():
+            mapping[region_id] = mapped_id
+            provenance[region_id] = 'distance'
+
+    if not (return_provenance or return_scores):
+        return mapping
+    results = (mapping,)
+    if return_provenance:
+        results += (provenance,)
+    if return_scores:
+        results += (compute_match_scores(image1_labels, image2_labels, mapping),)
+    return results
+
+
+def overlap_table(image1_labels, image2_labels):
+    """
+    Compute the overlap between every pair of intersecting regions in a single pass.
+
+    :param image1_labels: Labeled regions of the first image.
+    :param image2_labels: Labeled regions of the second image, on the same voxel grid.
+    :return: Arrays of region IDs of image1, region IDs of image2 and intersection sizes (voxels)
+             for each overlapping pair, and the region sizes of both images indexed by region ID.
+    """
+    both = (image1_labels != 0) & (image2_labels != 0)
+    # One integer key per pair of region IDs
+    stride = int(image2_labels.max()) + 1
+    pairs, intersections = np.unique(image1_labels[both].astype(np.int64) * stride + image2_labels[both],
+                                     return_counts=True)
+    # Only the labeled voxels are counted, bincount would otherwise copy the whole volume to int64
+    sizes1 = np.bincount(image1_labels[image1_labels != 0])
+    sizes2 = np.bincount(image2_labels[image2_labels != 0])
+    return pairs // stride, pairs % stride, intersections, sizes1, sizes2
 
+
+def _overlap_scores(intersections, size1, size2, score):
+    """
+    Convert intersection sizes into an overlap score.
+
+    :param score: 'overlap' (voxels), 'iou' or 'dice'.
+    :return: Array of scores.
+    """
+    if score == 'overlap':
+        return intersections.astype(float)
+    if score == 'iou':
+        return intersections / (size1 + size2 - intersections)
+    if score == 'dice':
+        return 2 * intersections / (size1 + size2)
+    raise ValueError(f"Unknown overlap score: {score}")
+
+
+def assign_regions(image1_labels, image2_labels, score='iou'):
+    """
+    Build a one-to-one mapping between regions maximising the total overlap score.
+
+    The overlap graph is split into connected blocks of candidate pairs and the Hungarian
+    algorithm is solved on each block independently, so the cost stays small even with
+    many lesions. Regions without an assigned partner are mapped to None.
+
+    :param image1_labels: Labeled regions of the first image.
+    :param image2_labels: Labeled regions of the second image, on the same voxel grid.
+    :param score: Score maximised by the assignment: 'overlap', 'iou' or 'dice'.
+    :return: Dictionary mapping region IDs from image1 to region IDs in image2 (or None).
+    """
+    mapping = {region_id: None for region_id in np.unique(image1_labels)[1:]}
+    ids1, ids2, intersections, sizes1, sizes2 = overlap_table(image1_labels, image2_labels)
+    if len(intersections) == 0:
+        return mapping
+    scores = _overlap_scores(intersections, sizes1[ids1], sizes2[ids2], score)
+
+    # Bipartite graph of candidate pairs: nodes of image1 first, then nodes of image2
+    rows, row_index = np.unique(ids1, return_inverse=True)
+    cols, col_index = np.unique(ids2, return_inverse=True)
+    graph = coo_matrix((np.ones(len(scores)), (row_index, len(rows) + col_index)),
+                       shape=(len(rows) + len(cols),) * 2)
+    _, components = connected_components(graph, directed=False)
+
+    pair_components = components[row_index]
+    for component in np.unique(pair_components):
+        in_block = pair_components == component
+        block_rows, local_rows = np.unique(row_index[in_block], return_inverse=True)
+        block_cols, local_cols = np.unique(col_index[in_block], return_inverse=True)
+        block_scores = np.zeros((len(block_rows), len(block_cols)))
+        block_scores[local_rows, local_cols] = scores[in_block]
+        assigned_rows, assigned_cols = linear_sum_assignment(block_scores, maximize=True)
+        for r, c in zip(assigned_rows, assigned_cols):
+            if block_scores[r, c] > 0:
+                mapping[rows[block_rows[r]]] = cols[block_cols[c]]
     return mapping
 
-def compute_region_properties(labeled_image):
+
+def compute_match_scores(image1_labels, image2_labels, region_mapping):
+    """
+    Compute the overlap, Dice and IoU of every matched pair of regions.
+
+    :param image1_labels: Labeled regions of the first image.
+    :param image2_labels: Labeled regions of the second image, on the same voxel grid.
+    :param region_mapping: Dictionary mapping region IDs from image1 to image2.
+    :return: Dictionary mapping each matched region ID of image1 to its 'overlap', 'dice' and 'iou'.
+    """
+    ids1, ids2, intersections, sizes1, sizes2 = overlap_table(image1_labels, image2_labels)
+    pair_overlaps = dict(zip(zip(ids1, ids2), intersections))
+    scores = {}
+    for region1_id, region2_id in region_mapping.items():
+        if region2_id is None:
+            continue
+        overlap = np.int64(pair_overlaps.get((region1_id, region2_id), 0))
+        size1, size2 = sizes1[region1_id], sizes2[region2_id]
+        scores[region1_id] = {'overlap': int(overlap),
+                              'dice': float(_overlap_scores(overlap, size1, size2, 'dice')),
+                              'iou': float(_overlap_scores(overlap, size1, size2, 'iou'))}
+    return scores
+
+
+def _surface_voxels(labeled_image, region_ids):
     """
-    Compute the center and volume for each region in the labeled image.
+    Find the voxels on the boundary of the given regions (6-connectivity).
 
     :param labeled_image: Labeled image array.
-    :return: Dictionary mapping each region ID to its center and volume.
+    :param region_ids: Region IDs whose surface voxels are returned.
+    :return: Array (N, 3) of voxel coordinates and array (N,) of their region IDs.
     """
+    structure = ndimage.generate_binary_structure(3, 1)
+    eroded = ndimage.grey_erosion(labeled_image, footprint=structure, mode='constant', cval=0)
+    dilated = ndimage.grey_dilation(labeled_image, footprint=structure, mode='constant', cval=0)
+    surface = (labeled_image != eroded) | (labeled_image != dilated)
+    surface &= np.isin(labeled_image, region_ids)
+    coords = np.argwhere(surface)
+    return coords, labeled_image[surface]
+
+
+def match_regions_by_distance(image1_labels, image2_labels, region1_ids, region2_ids, max_distance, affine=None,
+                              mode='centroid'):
+    """
+    Match regions of image1 to the nearest region of image2 within a distance threshold.
+
+    KD-trees restrict the search to pairs closer than max_distance so that it stays
+    sub-quadratic in the number of lesions. Pairs are claimed from the closest one on,
+    so each region of image2 is matched at most once.
+
+    :param image1_labels: Labeled regions of the first image.
+    :param image2_labels: Labeled regions of the second image, on the same voxel grid.
+    :param region1_ids: Region IDs of image1 to match.
+    :param region2_ids: Candidate region IDs of image2.
+    :param max_distance: Maximum distance (mm) between matched regions.
+    :param affine: Voxel-to-world affine of both label volumes, or None for voxel units.
+    :param mode: 'centroid' to compare centroids, 'surface' to compare the nearest surface voxels.
+    :return: Dictionary mapping the matched region IDs of image1 to region IDs of image2.
+    """
+    if len(region1_ids) == 0 or len(region2_ids) == 0:
+        return {}
+    if mode == 'centroid':
+        centroids1 = region_centroids_world(image1_labels, affine)
+        centroids2 = region_centroids_world(image2_labels, affine)
+        points1, owners1 = np.array([centroids1[region_id] for region_id in region1_ids]), np.asarray(region1_ids)
+        points2, owners2 = np.array([centroids2[region_id] for region_id in region2_ids]), np.asarray(region2_ids)
+    elif mode == 'surface':
+        coords1, owners1 = _surface_voxels(image1_labels, region1_ids)
+        coords2, owners2 = _surface_voxels(image2_labels, region2_ids)
+        points1, points2 = voxel_to_world(coords1, affine), voxel_to_world(coords2, affine)
+    else:
+        raise ValueError(f"Unknown distance matching mode: {mode}")
+    if len(points1) == 0 or len(points2) == 0:
+        return {}
+
+    # All point pairs within the threshold, reduced to the smallest distance of every region pair
+    pairs = cKDTree(points1).sparse_distance_matrix(cKDTree(points2), max_distance, output_type='ndarray')
+    pair_owners1, pair_owners2 = owners1[pairs['i']], owners2[pairs['j']]
+    order = np.lexsort((pairs['v'], pair_owners2, pair_owners1))
+    pair_owners1, pair_owners2, distances = pair_owners1[order], pair_owners2[order], pairs['v'][order]
+    first = np.r_[True, (pair_owners1[1:] != pair_owners1[:-1]) | (pair_owners2[1:] != pair_owners2[:-1])]
+    pair_owners1, pair_owners2, distances = pair_owners1[first], pair_owners2[first], distances[first]
+
+    # Closest pairs claim first so that every region of image2 is matched at most once
+    matches = {}
+    claimed = set()
+    for index in np.lexsort((pair_owners2, pair_owners1, distances)):
+        region1_id, region2_id = pair_owners1[index], pair_owners2[index]
+        if region1_id not in matches and region2_id not in claimed:
+            matches[region1_id] = region2_id
+            claimed.add(region2_id)
+    return matches
+
+
+def _region_sums(labeled_image):
+    """
+    Accumulate voxel counts and coordinate sums for every region in a single pass.
+
+    :param labeled_image: Labeled image array.
+    :return: Region IDs, voxel counts per region and voxel-space centers (N, 3) per region.
+    """
+    indices = np.nonzero(labeled_image)
+    labels = labeled_image[indices]
+    region_ids = np.unique(labels)
+    if region_ids.size == 0:
+        return region_ids, np.zeros(0, dtype=int), np.zeros((0, 3))
+    counts = np.bincount(labels)[region_ids]
+    centers = np.stack([np.bincount(labels, weights=axis_indices)[region_ids] for axis_indices in indices], axis=1)
+    centers /= counts[:, None]
+    return region_ids, counts, centers
+
+
+def region_centroids_world(labeled_image, affine=None):
+    """
+    Compute the world-space centroid of each region in the labeled image.
+
+    :param labeled_image: Labeled image array.
+    :param affine: Voxel-to-world affine, or None to stay in voxel coordinates.
+    :return: Dictionary mapping each region ID to its centroid in mm.
+    """
+    region_ids, _, centers = _region_sums(labeled_image)
+    return dict(zip(region_ids, voxel_to_world(centers, affine)))
+
+
+def _region_surface_areas(labeled_image, zooms, num_labels):
+    """
+    Compute the surface area of every region by counting exposed voxel faces along each axis.
+
+    :param labeled_image: Labeled image array.
+    :param zooms: Voxel sizes (mm) along each axis.
+    :param num_labels: Length of the output array (maximum region ID + 1).
+    :return: Array indexed by region ID with the surface area in mm^2.
+    """
+    areas = np.zeros(num_labels)
+    padded = np.pad(labeled_image, 1)
+    for axis in range(3):
+        face_area = np.prod(np.delete(zooms, axis))
+        lower = padded[tuple(slice(None, -1) if a == axis else slice(None) for a in range(3))]
+        upper = padded[tuple(slice(1, None) if a == axis else slice(None) for a in range(3))]
+        boundary = lower != upper
+        # Each face between two different labels belongs to both sides (background is dropped)
+        for side in (lower[boundary], upper[boundary]):
+            areas += np.bincount(side, minlength=num_labels)[:num_labels] * face_area
+    return areas
+
+
+def compute_region_properties(labeled_image, affine=None):
+    """
+    Compute the center, volume and physical-space metrics for each region in the labeled image.
+
+    Voxel-space values ('center', 'volume') are kept for plotting; the '_mm' and '_world'
+    values use the affine so that lesions can be compared across scanners.
+
+    :param labeled_image: Labeled image array.
+    :param affine: Voxel-to-world affine, or None for unit voxels.
+    :return: Dictionary mapping each region ID to its center, volume and physical-space metrics.
+    """
+    zooms = voxel_sizes(affine)
+    region_ids, counts, centers = _region_sums(labeled_image)
+    if region_ids.size == 0:
+        return {}
+    centers_world = voxel_to_world(centers, affine)
+    surface_areas = _region_surface_areas(labeled_image, zooms, region_ids.max() + 1)
+    bounding_boxes = ndimage.find_objects(labeled_image)
+
     properties = {}
-    for region_id in np.unique(labeled_image)[1:]:  # Skip the background
-        indices = np.where(labeled_image == region_id)
-        center = np.mean(indices, axis=1)
-        volume = len(indices[0])
-        properties[region_id] = {'center': center, 'volume': volume}
+    for region_id, center, center_world, volume in zip(region_ids, centers, centers_world, counts):
+        bbox = bounding_boxes[region_id - 1]
+        extent = np.array([s.stop - s.start for s in bbox])
+        properties[region_id] = {'center': center,
+                                 'volume': int(volume),
+                                 'center_world': center_world,
+                                 'volume_mm3': float(volume * np.prod(zooms)),
+                                 'surface_area_mm2': float(surface_areas[region_id]),
+                                 'bbox': bbox,
+                                 'extent_mm': extent * zooms}
     return properties
 
 
+def compute_difference_volume(image1_data, image2_data):
+    """
+    Compute the voxel-wise change between two binary lesion masks.
+
+    :param image1_data: Lesion mask of the first time point.
+    :param image2_data: Lesion mask of the second time point, on the same voxel grid.
+    :return: Array with 1 for white to white, 2 for white to black, 3 for black to white and 0 otherwise.
+    """
+    difference_volume = np.zeros_like(image1_data)
+    difference_volume[np.where((image1_data == 1) & (image2_data == 1))] = 1  # White to white
+    difference_volume[np.where((image1_data == 1) & (image2_data == 0))] = 2  # White to black
+    difference_volume[np.where((image1_data == 0) & (image2_data == 1))] = 3  # Black to white
+    return difference_volume
+
+
 def get_mapped_id(region_id_image2, region_mapping):
     """
     Get the corresponding region ID from image 1 for a region ID in image 2 based on the mapping.
@@ -117,7 +832,8 @@ def count_none_mappings(region_mapping):
     none_count = sum(value is None for value in region_mapping.values())
     return none_count
 def save_mapping_data_to_json(region_mapping, region_mapping_backward, image1_data, image2_data, image1_labels, image2_labels,
-                              file_name="region_mapping_log.json"):
+                              file_name="region_mapping_log.json", provenance=None, provenance_backward=None,
+                              match_scores=None, match_scores_backward=None):
     """
     Convert all NumPy data types to Python types and save the region mapping data and lesion counts to a JSON file.
 
@@ -126,6 +842,10 @@ def save_mapping_data_to_json(region_mapping, region_mapping_backward, image1_da
     :param image1_data: Image data for the first time point.
     :param image2_data: Image data for the second time point.
     :param file_name: Name of the file to save the JSON data.
+    :param provenance: Optional match provenance ('overlap', 'distance' or None) of the forward mapping.
+    :param provenance_backward: Optional match provenance of the backward mapping.
+    :param match_scores: Optional overlap, Dice and IoU of each forward match (see compute_match_scores).
+    :param match_scores_backward: Optional overlap, Dice and IoU of each backward match.
     """
     # Convert NumPy data types to Python for the entire data structure
     region_mapping_python = convert_numpy_to_python(region_mapping)
@@ -139,6 +859,14 @@ def save_mapping_data_to_json(region_mapping, region_mapping_backward, image1_da
         "disappeared_lesions": count_none_mappings(region_mapping),
         "new_lesions": count_none_mappings(region_mapping_backward)
     }
+    if provenance is not None:
+        data_to_save["match_provenance_forward"] = convert_numpy_to_python(provenance)
+    if provenance_backward is not None:
+        data_to_save["match_provenance_backward"] = convert_numpy_to_python(provenance_backward)
+    if match_scores is not None:
+        data_to_save["match_scores_forward"] = convert_numpy_to_python(match_scores)
+    if match_scores_backward is not None:
+        data_to_save["match_scores_backward"] = convert_numpy_to_python(match_scores_backward)
 
     # Write to JSON file
     with open(file_name, 'w') as outfile:
@@ -1,5 +1,7 @@
+import json
 import matplotlib.pyplot as plt
 from matplotlib import patches
+from matplotlib.colors import ListedColormap
 import numpy as np
 from utils import get_mapped_id
 
@@ -72,7 +74,7 @@ def plot_region_center_full_size(image_data, region_properties, region_id, out_n
 
 
 def plot_labeled_regions_with_mapping(image1_data, image1_labels, image2_data, image2_labels, region_mapping,
-                                      slice_index):
+                                      slice_index, show=True):
     """
     Plot slices from both images with labeled regions annotated, including the mapping on the second image.
 
@@ -82,6 +84,7 @@ def plot_labeled_regions_with_mapping(image1_data, image1_labels, image2_data, i
     :param image2_labels: 3D numpy array with labeled regions for the second image.
     :param region_mapping: Dictionary mapping region IDs from image1 to image2.
     :param slice_index: Index of the slice to be plotted for both images.
+    :param show: Whether to display the figure after saving it.
     """
     fig, axs = plt.subplots(1, 2, figsize=(12, 6))
 
@@ -110,7 +113,8 @@ def plot_labeled_regions_with_mapping(image1_data, image1_labels, image2_data, i
 
     plt.tight_layout()
     plt.savefig("output/labels_lesions")
-    plt.show()
+    if show:
+        plt.show()
     plt.close()
 
 
@@ -118,6 +122,49 @@ def plot_labeled_regions_with_mapping(image1_data, image1_labels, image2_data, i
 
 
 
+def plot_difference_slice(image1_data, image2_data, difference_volume, slice_index, show=True):
+    """
+    Plot a slice of both lesion masks next to the color-coded difference between them.
+
+    :param image1_data: 3D numpy array of the first lesion mask.
+    :param image2_data: 3D numpy array of the second lesion mask.
+    :param difference_volume: 3D difference array (see compute_difference_volume).
+    :param slice_index: Index of the slice to be plotted.
+    :param show: Whether to display the figure after saving it.
+    """
+    # Define the colormap for the difference image
+    cmap = ListedColormap(['black', 'green', 'blue', 'red'])
+
+    fig, axes = plt.subplots(1, 3, figsize=(18, 6))
+
+    # Display Image 1
+    axes[0].imshow(image1_data[:, :, slice_index], cmap='gray')
+    axes[0].set_title(f"Image 1: Slice {slice_index}")
+    axes[0].axis('off')
+
+    # Display Image 2
+    axes[1].imshow(image2_data[:, :, slice_index], cmap='gray')
+    axes[1].set_title(f"Image 2: Slice {slice_index}")
+    axes[1].axis('off')
+
+    # Display the Difference Image
+    im = axes[2].imshow(difference_volume[:, :, slice_index], cmap=cmap, vmin=0, vmax=3)
+    axes[2].set_title(f"Difference: Slice {slice_index}")
+    axes[2].axis('off')
+
+    # Add colorbar to explain the difference image, placing it outside the subplot
+    fig.subplots_adjust(right=0.85)
+    cbar_ax = fig.add_axes([0.88, 0.15, 0.02, 0.7])  # Positioning the colorbar
+    cbar = fig.colorbar(im, cax=cbar_ax, ticks=[0, 1, 2, 3])
+    cbar.set_ticklabels(['No Change (Black)', 'Unchanged (White to White)', 'Decrease (White to Black)', 'Increase (Black to White)'])
+    cbar.ax.set_ylabel('Change Type', rotation=270, labelpad=15)
+    plt.title("Showing the lesion progression")
+    plt.savefig("output/difference_lesions")
+    if show:
+        plt.show()
+    plt.close()
+
+
 def plot_region_center_full_size_bg(background_data, lesion_data, region_properties, region_id, out_number, zoom_size=10):
     """
     Plot the lesion region highlighted on the sagittal view of the background image.
@@ -221,6 +268,149 @@ def plot_region_center_full_size_bg_top(background_data, lesion_data, region_pro
     #plt.show()
 
 
+def extract_lesion_tiles(background_data, lesion_data, region_properties, tile_size=None, margin=8):
+    """
+    Crop a sagittal tile around every lesion from the background and lesion volumes at once.
+
+    All tiles are gathered with a single fancy-indexing operation on the padded volumes.
+    Tiles are oriented like plot_region_center_full_size_bg (z upwards, y to the right).
+
+    :param background_data: The 3D background image data array.
+    :param lesion_data: The 3D labeled lesion image array.
+    :param region_properties: Properties of the lesion regions (see compute_region_properties).
+    :param tile_size: Side of each square tile in voxels; by default the largest lesion bounding box plus margin.
+    :param margin: Voxels added around the largest bounding box when tile_size is not given.
+    :return: Region IDs, background tiles (N, tile_size, tile_size) and lesion masks of the same shape.
+    """
+    region_ids = np.array(list(region_properties))
+    if tile_size is None:
+        extents = [max(bbox[1].stop - bbox[1].start, bbox[2].stop - bbox[2].start)
+                   for bbox in (region_properties[region_id]['bbox'] for region_id in region_ids)]
+        tile_size = max(extents, default=0) + 2 * margin
+    if region_ids.size == 0:
+        empty = np.zeros((0, tile_size, tile_size))
+        return region_ids, empty, empty.astype(bool)
+    centers = np.array([region_properties[region_id]['center'] for region_id in region_ids])
+    half = tile_size // 2
+    x = np.clip(centers[:, 0].astype(int), 0, background_data.shape[0] - 1)
+    # Window start in the padded volume (padding shifts every index by half)
+    y = np.round(centers[:, 1]).astype(int)
+    z = np.round(centers[:, 2]).astype(int)
+    window = np.arange(tile_size)
+    ys = (y[:, None] + window)[:, :, None]
+    zs = (z[:, None] + window)[:, None, :]
+    padding = ((0, 0), (half, tile_size), (half, tile_size))
+    background_tiles = np.pad(background_data, padding)[x[:, None, None], ys, zs]
+    lesion_tiles = np.pad(lesion_data, padding)[x[:, None, None], ys, zs] == region_ids[:, None, None]
+    # (y, z) -> (z, y) with z pointing upwards
+    background_tiles = background_tiles.transpose(0, 2, 1)[:, ::-1, :]
+    lesion_tiles = lesion_tiles.transpose(0, 2, 1)[:, ::-1, :]
+    return region_ids, background_tiles, lesion_tiles
+
+
+def tile_mosaic(tiles, columns):
+    """
+    Arrange a stack of tiles into a single 2D mosaic array.
+
+    :param tiles: Array of shape (N, height, width).
+    :param columns: Number of tiles per row.
+    :return: Mosaic array of shape (rows * height, columns * width), empty tiles are zero.
+    """
+    count, height, width = tiles.shape
+    rows = max(-(-count // columns), 1)
+    grid = np.zeros((rows * columns, height, width), dtype=tiles.dtype)
+    grid[:count] = tiles
+    return grid.reshape(rows, columns, height, width).transpose(0, 2, 1, 3).reshape(rows * height, columns * width)
+
+
+def plot_lesion_montage(background_data, lesion_data, region_properties, out_number, tile_size=None, columns=8,
+                        tiles_per_page=64, margin=8):
+    """
+    Plot all the lesions of one time point as a montage of sagittal tiles, one image per page.
+
+    An index mapping each tile of each page to its lesion ID is written next to the images
+    as montage_index.json, for use by the report and the GUI, together with the pixel extent
+    of the mosaic in each page image (see montage_tile_boxes).
+
+    :param background_data: The 3D background image data array.
+    :param lesion_data: The 3D labeled lesion image array.
+    :param region_properties: Properties of the lesion regions.
+    :param out_number: Output number for file naming.
+    :param tile_size: Side of each square tile in voxels; by default fitted to the largest lesion.
+    :param columns: Number of tiles per row.
+    :param tiles_per_page: Maximum number of tiles in a single image.
+    :param margin: Voxels added around the largest lesion when tile_size is not given.
+    :return: Dictionary mapping each page file name to the list of lesion IDs in tile order.
+    """
+    out_dir = f'lesions_out/lesions_{out_number}'
+    region_ids, background_tiles, lesion_tiles = extract_lesion_tiles(background_data, lesion_data,
+                                                                      region_properties, tile_size, margin)
+    tile_size = background_tiles.shape[1]
+    index = {}
+    extents = {}
+    for page, start in enumerate(range(0, len(region_ids), tiles_per_page)):
+        page_ids = region_ids[start:start + tiles_per_page]
+        mosaic = tile_mosaic(background_tiles[start:start + tiles_per_page], columns)
+        lesion_mosaic = tile_mosaic(lesion_tiles[start:start + tiles_per_page], columns)
+
+        rows = mosaic.shape[0] // tile_size
+        fig, ax = plt.subplots(figsize=(columns * 1.5, rows * 1.5))
+        ax.imshow(mosaic, cmap='gray', interpolation='none')
+        ax.imshow(np.ma.masked_where(~lesion_mosaic, lesion_mosaic), cmap='autumn', alpha=0.7, interpolation='none')
+        for tile, region_id in enumerate(page_ids):
+            row, col = divmod(tile, columns)
+            ax.text(col * tile_size + 1, row * tile_size + 1, str(region_id), color='yellow', fontsize=7,
+                    ha='left', va='top')
+        ax.set_xticks(np.arange(0, mosaic.shape[1] + 1, tile_size) - 0.5, minor=True)
+        ax.set_yticks(np.arange(0, mosaic.shape[0] + 1, tile_size) - 0.5, minor=True)
+        ax.grid(which='minor', color='white', linewidth=0.5)
+        ax.tick_params(which='both', bottom=False, left=False, labelbottom=False, labelleft=False)
+        ax.set_title(f"Lesions of time point {out_number} (page {page + 1})")
+
+        file_name = f'montage_{page + 1}.png'
+        # Tight bounding box computed here so that the mosaic position in the saved image is known
+        fig.canvas.draw()
+        renderer = fig.canvas.get_renderer()
+        bbox = fig.get_tightbbox(renderer).padded(plt.rcParams['savefig.pad_inches'])
+        axes = ax.get_window_extent(renderer)
+        plt.savefig(f'{out_dir}/{file_name}', bbox_inches=bbox, dpi=fig.dpi)
+        plt.close()
+        index[file_name] = [int(region_id) for region_id in page_ids]
+        # (left, top, right, bottom) in pixels of the saved image, y pointing downwards
+        extents[file_name] = [round(axes.x0 - bbox.x0 * fig.dpi), round(bbox.y1 * fig.dpi - axes.y1),
+                              round(axes.x1 - bbox.x0 * fig.dpi), round(bbox.y1 * fig.dpi - axes.y0)]
+
+    with open(f'{out_dir}/montage_index.json', 'w') as outfile:
+        json.dump({'tile_size': int(tile_size), 'columns': columns, 'pages': index, 'extents': extents}, outfile,
+                  indent=4)
+    return index
+
+
+def montage_tile_boxes(montage_directory):
+    """
+    Locate the tile of each lesion in the montage images written by plot_lesion_montage.
+
+    :param montage_directory: Directory containing the montage images and montage_index.json.
+    :return: Dictionary mapping each lesion ID to its page file name and (left, top, right, bottom) pixel box,
+             in the order of the montage.
+    """
+    with open(f'{montage_directory}/montage_index.json') as infile:
+        montage_index = json.load(infile)
+    columns = montage_index['columns']
+    boxes = {}
+    for file_name, lesion_ids in montage_index['pages'].items():
+        left, top, right, bottom = montage_index['extents'][file_name]
+        rows = max(-(-len(lesion_ids) // columns), 1)
+        tile_width = (right - left) / columns
+        tile_height = (bottom - top) / rows
+        for tile, lesion_id in enumerate(lesion_ids):
+            row, col = divmod(tile, columns)
+            boxes[lesion_id] = (file_name, (round(left + col * tile_width), round(top + row * tile_height),
+                                            round(left + (col + 1) * tile_width),
+                                            round(top + (row + 1) * tile_height)))
+    return boxes
+
+
 # def plot_region_center(image_data, region_properties, region_id, number, zoom_size=100):
 #     """
 #     Plot the region centered at its mean coordinate with a zoom-in effect.